@@ -126,6 +126,7 @@ def entrypoint():
         sys.exit(-2)
     except Exception as ex:
         logger.error(f"{type(ex).__name__}: {ex}")
+        sys.exit(-3)
 
 
 if __name__ == "__main__":
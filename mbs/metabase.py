@@ -15,18 +15,56 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
+import hashlib
 import json
 import logging
+import re
 import sys
 import os
-from pathlib import Path, PureWindowsPath
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PureWindowsPath
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Union
 from platformdirs import user_config_dir
 import jinja2
+import ijson
+import orjson
 
 
-logger = logging.getLogger()
+logger = logging.getLogger(__name__)
+
+# characters we keep when turning a card name into a filename
+_TITLE_RE = re.compile(r"[^A-Za-z0-9 ._-]+")
+
+
+def _escape_json(data):
+    """
+    Jinja filter that JSON-escapes a value; strings are emitted without the
+    surrounding quotes so they can be embedded in template strings.
+    """
+    b = orjson.dumps(data)
+    return b[1:-1].decode() if b.startswith(b'"') else b.decode()
+
+
+def _iter_json(root, exclude_dirs=frozenset()):
+    """
+    Lazily yield the paths of all *.json files below root, pruning hidden
+    directories and everything in exclude_dirs (paths, resolved relative to
+    root) during the walk.
+    """
+    excluded = {os.path.normpath(os.path.join(root, d)) for d in exclude_dirs}
+    stack = [root]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.normpath(entry.path) not in excluded:
+                    stack.append(entry.path)
+            elif entry.name.endswith(".json") and entry.is_file():
+                yield entry.path
 
 
 class MbsException(Exception):
@@ -47,12 +85,53 @@ class Metabase:
     user_config_dir = user_config_dir(appname, author)
     remotes_config_file = os.path.join(user_config_dir, "remotes.json")
     include_default_folder = "include"
+    pull_cache_file = ".mbs_cache.json"
+    push_cache_file = ".mbs_push_cache.json"
+    push_workers = 8
+    # values that metabase will manage himself, dropped from pulled cards
+    drop_fields = ("created_at", "creator", "creator_id", "last-edit-info", "made_public_by_id",
+                   "public_uuid", "updated_at", "embedding_params", "enable_embedding",
+                   "average_query_time", "last_query_start", "moderation_reviews")
+    _config_cache = {}  # (abspath) -> (mtime_ns, parsed dict), shared by all instances
 
     def __init__(self, include_folder=include_default_folder, init_url=None):
         self.mbs_tag = "## mbs_controlled ##"
 
         self.include_folder = include_folder
 
+        # one session for all API calls, so repeated requests to the same host
+        # reuse the pooled TCP/TLS connections instead of reconnecting each time
+        self._http = requests.Session()
+        self._http.headers.update({
+            "Content-Type": "application/json; charset=utf-8",
+            "User-Agent": "MetaBaseSync"
+        })
+        # retry transient gateway errors with backoff on the pooled connection,
+        # so a busy Metabase doesn't abort a long pull/push
+        retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      allowed_methods=["GET", "PUT", "POST"])
+        # pool_block makes extra workers wait for a pooled connection instead
+        # of opening throwaway sockets past the pool size
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=20, pool_block=True)
+        self._http.mount("https://", adapter)
+        self._http.mount("http://", adapter)
+
+        # build the template environment once, so templates compiled on the first
+        # render are served from jinja's template cache on subsequent renders
+        # templates don't change during a CLI run, so keep every compiled
+        # template and skip the per-render staleness stat()s
+        self._jenv = jinja2.Environment(
+            loader=jinja2.FileSystemLoader([os.getcwd(), self.include_folder], followlinks=True),
+            autoescape=False,
+            cache_size=-1,
+            auto_reload=False
+        )
+        self._jenv.filters['json'] = _escape_json
+
+        self._remotes_cache = None
+        self._remotes_mtime = None
+        self._existing_files = None
+
         if init_url:
             if not os.path.isfile(".mbs"):
                 init_url = init_url.strip("/")  # strip trailing slashes
@@ -64,23 +143,39 @@ class Metabase:
                 raise MbsFatalException("There is already an mbs repo in this folder.")
         else:
             if os.path.isfile(".mbs"):
-                with open(".mbs") as f:
-                    self.config = json.load(f)
+                self.config = self._read_json_cached(".mbs")
             else:
                 raise MbsFatalException("This folder is not a valid mbs repo. Use 'mbs init <url>' "
                                         "to create a new repo first.")
 
-            if os.path.isfile(self.user_config_dir):
-                with open(self.remotes_config_file) as f:
-                    credentials = json.load(f)
+    @classmethod
+    def _read_json_cached(cls, path):
+        """
+        Parse a small JSON config file, reusing the parsed dict across
+        Metabase instances until the file changes on disk.
+        """
+        key = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = cls._config_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as f:
+                cached = (mtime, orjson.loads(f.read()))
+            cls._config_cache[key] = cached
+        return cached[1]
 
     @property
     def remotes(self):
-        if os.path.isfile(self.remotes_config_file):
-            with open(self.remotes_config_file) as f:
-                return json.load(f)
-        else:
+        try:
+            mtime = os.stat(self.remotes_config_file).st_mtime_ns
+        except OSError:
             raise MbsFatalException("You are currently not logged in. Use \"mbs login\" with your credentials")
+        # parse the file once and reuse the dict until it changes on disk,
+        # instead of re-reading it for every single API call
+        if self._remotes_cache is None or mtime != self._remotes_mtime:
+            with open(self.remotes_config_file, "rb") as f:
+                self._remotes_cache = orjson.loads(f.read())
+            self._remotes_mtime = mtime
+        return self._remotes_cache
 
     @property
     def session(self):
@@ -103,36 +198,44 @@ class Metabase:
         else:
             return False
 
-    def _get(self, path):
-        headers = {
-            "Content-Type": "application/json; charset=utf-8",
-            "X-Metabase-Session": self.session,
-            'User-Agent': 'MetaBaseSync'
-        }
-        req = requests.get(self.config["url"] + path, headers=headers)
-        if req.status_code not in [200]:
-            if req.text == "Unauthenticated":
+    def _request(self, method, path, data=None):
+        # one retry after renewing an expired session, as a loop instead of
+        # recursion, so stale credentials can't retry forever
+        for attempt in range(2):
+            req = self._http.request(method, self.config["url"] + path,
+                                     headers={"X-Metabase-Session": self.session}, json=data)
+            if req.status_code in (200, 202):
+                return req.json()
+            if req.text == "Unauthenticated" and attempt == 0:
                 self.renew_session()
-                return self._get(path)
-            else:
-                raise MbsFatalException("Error: " + req.text)
-        return req.json()
+                continue
+            raise MbsFatalException("Error: " + req.text)
+
+    def _get(self, path):
+        return self._request("GET", path)
 
     def _put(self, path, data):
-        headers = {
-            "Content-Type": "application/json; charset=utf-8",
-            "X-Metabase-Session": self.session,
-            'User-Agent': 'MetaBaseSync'
-        }
-        req = requests.put(self.config["url"] + path, headers=headers, json=data)
-        if req.status_code not in [200, 202]:
-            if req.text == "Unauthenticated":
-                self.renew_session()
-                return self._put(path, data)
-            else:
-                raise MbsFatalException("Error: " + req.text)
+        return self._request("PUT", path, data)
 
-        return req.json()
+    def _get_stream(self, path):
+        """
+        Stream the items of a JSON array response one at a time, so endpoints
+        like "/api/card" don't need the whole payload in memory at once.
+        """
+        # one retry after renewing an expired session, bounded like _request
+        for attempt in range(2):
+            req = self._http.get(self.config["url"] + path, headers={"X-Metabase-Session": self.session},
+                                 stream=True)
+            if req.status_code == 200:
+                break
+            if req.text == "Unauthenticated" and attempt == 0:
+                self.renew_session()
+                continue
+            raise MbsFatalException("Error: " + req.text)
+        req.raw.decode_content = True  # ijson reads the raw stream, so undo any content-encoding
+        # use_float keeps JSON numbers as floats instead of decimal.Decimal,
+        # which orjson can't serialize when the card is written back out
+        yield from ijson.items(req.raw, "item", use_float=True)
 
     def renew_session(self):
         if self.username and self.password:
@@ -145,12 +248,12 @@ class Metabase:
         url = self.config["url"]
 
         if os.path.isfile(self.remotes_config_file):  # we have credentials
-            with open(self.remotes_config_file) as f:
-                credentials = json.load(f)
+            with open(self.remotes_config_file, "rb") as f:
+                credentials = orjson.loads(f.read())
         else:
             credentials = {}
 
-        session_req = requests.post(url + "/api/session", json={"username": username, "password": password})
+        session_req = self._http.post(url + "/api/session", json={"username": username, "password": password})
 
         if session_req.status_code == 200 and "id" in session_req.json():  # success, lets save that
 
@@ -164,53 +267,90 @@ class Metabase:
             if not os.path.exists(self.user_config_dir):
                 os.makedirs(self.user_config_dir)
 
-            if os.path.isfile(self.remotes_config_file):
-                os.unlink(self.remotes_config_file)
-
-            with open(self.remotes_config_file, "w") as f:
-                json.dump(credentials, f, sort_keys=True, indent=4)
-                f.truncate()
+            # write to a tempfile and rename, so a crash can never leave a
+            # half-written credentials file behind
+            tmp = self.remotes_config_file + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps(credentials, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
+            os.replace(tmp, self.remotes_config_file)
+            self._remotes_cache = None  # force a reload after the file changed
             return True
         else:
             raise MbsFatalException(session_req.text)
 
     def pull(self, card_id=False, overwrite=False):
-        existing_ids = []
-        for file in list(Path.cwd().rglob("*.json")):  # gets files also in subdirectories
-            with open(file) as f:
-                card = json.load(f)
-                if "id" in card:
-                    existing_ids.append(card["id"])
+        # snapshot the working directory once, so __write_card can test for
+        # existing files with a set lookup instead of a stat per card
+        self._existing_files = {entry.name for entry in os.scandir(".") if entry.is_file()}
+        existing_ids = self._scan_existing_ids()
 
         if card_id:
             card = self._get("/api/card/" + str(card_id))
             self.__write_card(card, overwrite)
         else:
-            cards = self._get("/api/card")
             c = 0
-            for card in cards:
+            tag = self.mbs_tag
+            for card in self._get_stream("/api/card"):
                 if card["id"] in existing_ids:
                     logger.info(f"Skipping already existing id {card['id']}.")
                     continue
-                if ("native" in card["dataset_query"] and self.mbs_tag in card["dataset_query"]["native"]["query"]) or \
-                        (isinstance(card["description"], str) and self.mbs_tag in card["description"]):
+                query = (card["dataset_query"].get("native") or {}).get("query") or ""
+                description = card["description"]
+                if tag in query or (isinstance(description, str) and tag in description):
                     self.__write_card(card, overwrite)
                     c += 1
             logger.info(f"Found {c} new cards/questions with the mbs tag \"{self.mbs_tag}\".")
 
+    def _scan_existing_ids(self):
+        """
+        Collect the card ids of all local *.json files. Results are memoized
+        in pull_cache_file by mtime and size, so repeat pulls only parse
+        files that changed since the last run.
+        """
+        cache = self._read_cache(self.pull_cache_file)
+        new_cache = {}
+        existing_ids = set()
+        for file in _iter_json(os.getcwd()):
+            st = os.stat(file)
+            entry = cache.get(file)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                card_id = entry[2]
+            else:
+                with open(file, "rb") as f:
+                    raw = f.read()
+                # files without any "id" key can't be tracked cards, skip the parse
+                if b'"id"' in raw:
+                    card = orjson.loads(raw)
+                    card_id = card.get("id") if isinstance(card, dict) else None
+                else:
+                    card_id = None
+            new_cache[file] = [st.st_mtime_ns, st.st_size, card_id]
+            if card_id is not None:
+                existing_ids.add(card_id)
+        tmp = self.pull_cache_file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(new_cache))
+        os.replace(tmp, self.pull_cache_file)
+        return existing_ids
+
     def merge(self, filename=""):
         if filename:
             self.__merge_file(filename)
         else:
-            for file in list(Path.cwd().rglob("*.json")):  # gets files also in subdirectories
-                self.__merge_file(file)
+            # one listing request instead of one GET per file
+            cards_by_id = {card["id"]: card for card in self._get_stream("/api/card")}
+            for file in _iter_json(os.getcwd()):
+                self.__merge_file(file, cards_by_id)
 
-    def __merge_file(self, filename):
+    def __merge_file(self, filename, cards_by_id=None):
         if os.path.isfile(filename):
-            with open(filename) as f:
-                card = json.load(f)
+            with open(filename, "rb") as f:
+                card = orjson.loads(f.read())
                 if "id" in card:
-                    updated_card = self._get("/api/card/" + str(card["id"]))
+                    if cards_by_id is not None and card["id"] in cards_by_id:
+                        updated_card = cards_by_id[card["id"]]
+                    else:
+                        updated_card = self._get("/api/card/" + str(card["id"]))
                     if card["query_type"] == "native" and updated_card["query_type"] == "native":
                         updated_card["dataset_query"]["native"]["query"] = card["dataset_query"]["native"]["query"]
                         self.__write_card(updated_card, overwrite=True, filename=filename)
@@ -223,31 +363,26 @@ class Metabase:
 
     def __write_card(self, card, overwrite=False, filename=""):
         logger.info(f"Found mbs tag on cards/questions: {card['id']} ({card['name']})")
-        title = "".join(c for c in card["name"] if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()[:256]
+        title = _TITLE_RE.sub("", card["name"]).rstrip()[:256]
         if not filename:
             filename = f"{card['id']} - {title}.json"
-        if not os.path.isfile(f"{filename}") or overwrite:
-            # filter out some unnecessary values, that metabase will manage himself
-            try:
-                del card["created_at"]
-                del card["creator"]
-                del card["creator_id"]
-                del card["last-edit-info"]
-                del card["made_public_by_id"]
-                del card["public_uuid"]
-                del card["updated_at"]
-                del card["embedding_params"]
-                del card["enable_embedding"]
-                del card["average_query_time"]
-                del card["last_query_start"]
-                del card["moderation_reviews"]
-            except KeyError:
-                pass
-
-            with open(f"{filename}", "w") as f:
-                json.dump(card, f, sort_keys=True, indent=4)
-                f.truncate()
-                logger.info(f"Wrote \"{filename}\".")
+        if self._existing_files is not None:
+            exists = filename in self._existing_files
+        else:
+            exists = os.path.isfile(f"{filename}")
+        if not exists or overwrite:
+            for key in self.drop_fields:
+                card.pop(key, None)
+
+            # same tempfile-and-rename pattern as login(), so a concurrent
+            # reader never sees a half-written card file
+            tmp = f"{filename}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps(card, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
+            os.replace(tmp, f"{filename}")
+            logger.info(f"Wrote \"{filename}\".")
+            if self._existing_files is not None:
+                self._existing_files.add(filename)
         else:
             logger.warning(f"File \"{filename}\" already exists. You can force to overwrite "
                                 f"with the \"-o\" flag.")
@@ -263,33 +398,108 @@ class Metabase:
             else:
                 logger.info(f"Rendering and uploading file: {filename}")
                 output = self.render(filename)
-                if self.check(output):
-                    card = json.loads(output)
+                card = self.check(output)
+                if card:
                     self._put(f"/api/card/{card['id']}", card)
         else:
-            for file in list(Path.cwd().rglob("*.json")):  # gets files also in subdirectories
-                if self.include_folder not in os.path.dirname(file):
-                    logger.info(f"Rendering and uploading file: {file}")
-                    output = self.render(file)
-                    if render_only:
-                        print(output)
-                    else:
-                        if self.check(output):
-                            card = json.loads(output)
-                            self._put(f"/api/card/{card['id']}", card)
+            # the walk prunes the include folder itself, so partials are never uploaded
+            files = _iter_json(os.getcwd(), exclude_dirs=frozenset({self.include_folder}))
+            if render_only:
+                for file in files:
+                    logger.info(f"Rendering file: {file}")
+                    print(self.render(file))
+            else:
+                cache = self._read_cache(self.push_cache_file)
+                # any edit under the include folder can change every render,
+                # so a changed include state invalidates all cached entries
+                include_state = self._include_state()
+                if cache.get("__include_state__") != include_state:
+                    cache = {}
+                cache["__include_state__"] = include_state
+                # uploads are independent and network-bound, so run them in parallel
+                # over the shared, pooled session; one broken file shouldn't stop
+                # the others from being uploaded
+                with ThreadPoolExecutor(max_workers=self.push_workers) as executor:
+                    futures = {}
+                    for file in files:
+                        entry = self._push_cache_entry(file)
+                        if cache.get(file) == entry:
+                            logger.info(f"Skipping unchanged file: {file}")
+                            continue
+                        futures[executor.submit(self._render_and_put, file)] = (file, entry)
+                    failed = 0
+                    for future in as_completed(futures):
+                        file, entry = futures[future]
+                        try:
+                            future.result()
+                        except Exception as ex:
+                            # also network errors from exhausted retries; one bad
+                            # file must not abort the summary or the cache write
+                            logger.error(f"{file}: {type(ex).__name__}: {ex}")
+                            failed += 1
+                        else:
+                            cache[file] = entry  # uploaded successfully, skip it next time
+                tmp = self.push_cache_file + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(orjson.dumps(cache))
+                os.replace(tmp, self.push_cache_file)
+                if failed:
+                    raise MbsException(f"{failed} of {len(futures)} files failed to push.")
+
+    @staticmethod
+    def _read_cache(path):
+        """
+        Read one of the repo-local cache files. A missing, corrupted or
+        merge-conflicted cache just means nothing can be skipped this run,
+        so fall back to an empty one instead of aborting.
+        """
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                try:
+                    cache = orjson.loads(f.read())
+                    if isinstance(cache, dict):
+                        return cache
+                except orjson.JSONDecodeError:
+                    pass
+                logger.warning(f"Ignoring unreadable cache file \"{path}\".")
+        return {}
+
+    @staticmethod
+    def _push_cache_entry(file):
+        st = os.stat(file)
+        with open(file, "rb") as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        return {"mtime": st.st_mtime_ns, "size": st.st_size, "sha": sha}
+
+    def _include_state(self):
+        """
+        Fingerprint of every file under the include folder (path, mtime,
+        size), so cached pushes notice edits to included fragments.
+        """
+        h = hashlib.sha256()
+        if os.path.isdir(self.include_folder):
+            for root, dirs, names in os.walk(self.include_folder):
+                dirs.sort()
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    h.update(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\0".encode())
+        return h.hexdigest()
+
+    def _render_and_put(self, file):
+        logger.info(f"Rendering and uploading file: {file}")
+        output = self.render(file)
+        card = self.check(output)
+        if card:
+            self._put(f"/api/card/{card['id']}", card)
 
     def render(self, filename):
-        jenv = jinja2.Environment(
-            loader=jinja2.FileSystemLoader([os.getcwd(), self.include_folder], followlinks=True),
-            autoescape=False
-        )
-        jenv.filters['json'] = lambda a: json.dumps(a)[1:-1]
         if sys.platform == "win32":
             template_path = PureWindowsPath(os.path.relpath(filename, os.getcwd())).as_posix()
         else:
             template_path = os.path.relpath(filename, os.getcwd())
         try:
-            output = jenv .get_template(
+            output = self._jenv.get_template(
                 template_path
             ).render(
                 is_mbs=True,
@@ -310,14 +520,16 @@ class Metabase:
     def check(self, data: Union[str, dict]):
         """
         Validate data before uploading to metabase.
+        Returns the parsed card on success, so callers don't have to parse the
+        same data again.
         """
         error = False
         try:
             if isinstance(data, str):
-                card = json.loads(data)
+                card = orjson.loads(data)
             else:
                 card = data
-        except json.JSONDecodeError as e:
+        except json.JSONDecodeError as e:  # orjson's decode error subclasses this and keeps lineno/msg
             logger.error("JSON decode error while checking this output:")
             # print(data, "\nError:", e)
             logger.error(f"Render error: Line {e.lineno} - {e.msg}")
@@ -332,4 +544,4 @@ class Metabase:
         if error:
             raise MbsFatalException("Data invalid.")
         else:
-            return True
+            return card
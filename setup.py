@@ -11,7 +11,9 @@ setup(
         'click==8.1.*',
         'click-log==0.4.*',
         'platformdirs==2.5.*',
-        'jinja2==3.1.*'
+        'jinja2==3.1.*',
+        'ijson==3.*',
+        'orjson==3.*'
     ],
     entry_points={
         'console_scripts': [